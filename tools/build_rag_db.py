@@ -1,111 +1,111 @@
 #!/usr/bin/env python3
 """
 Build a SQLite RAG database from text files in kb/ directory.
-Embeddings are stored in a standard table for on-device cosine search.
+Embeddings are stored in a standard table for on-device cosine search,
+and with --backend vec (the default) also in a sqlite-vec virtual table.
+
+Usage: python build_rag_db.py [--backend {linear,vec}] [--int8]
 """
 
-import json
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
 import sqlite3
 from pathlib import Path
-from typing import List, Dict
+from itertools import islice
+from typing import Iterator, List, Optional, Tuple
 import numpy as np
 from tqdm import tqdm
-import onnxruntime as ort
 from transformers import AutoTokenizer
 
-def chunk_text(text: str, size: int = 500, overlap: int = 80) -> List[str]:
+from rag_common import (
+    create_session,
+    embed_text,
+    embed_token_ids,
+    linear_search,
+    int8_model_path,
+    load_onnx_model,
+    load_vec_extension,
+    serialize_f32,
+)
+
+BACKENDS = ("linear", "vec")
+
+
+def chunk_tokens(text: str, tokenizer, size: int = 384, overlap: int = 64) -> Iterator[Tuple[List[int], str]]:
     """
-    Chunk text into overlapping segments by word count.
+    Chunk text into overlapping windows of tokens, yielded one at a time.
+    
+    The document is tokenized once; each window's token ids are kept so they
+    can be embedded without re-tokenizing, and its text is sliced from the
+    original document using the tokenizer's character offsets.
     
     Args:
         text: Input text to chunk
-        size: Number of words per chunk
-        overlap: Number of overlapping words between chunks
+        tokenizer: HuggingFace (fast) tokenizer
+        size: Number of tokens per chunk
+        overlap: Number of overlapping tokens between chunks
     
-    Returns:
-        List of text chunks
+    Yields:
+        (token_ids, chunk_text) tuples
     """
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), size - overlap):
-        chunk = " ".join(words[i:i+size])
-        if chunk.strip():  # Only add non-empty chunks
-            chunks.append(chunk)
-    return chunks
-
-
-def load_onnx_model(model_path: str, tokenizer_path: str):
-    """Load ONNX model and tokenizer."""
-    print(f"Loading ONNX model from {model_path}")
-    session = ort.InferenceSession(model_path)
+    if size <= overlap:
+        raise ValueError(f"chunk size ({size}) must be larger than overlap ({overlap})")
     
-    print(f"Loading tokenizer from {tokenizer_path}")
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    ids = encoding["input_ids"]
+    offsets = encoding["offset_mapping"]
     
-    return session, tokenizer
+    for i in range(0, len(ids), size - overlap):
+        end = min(i + size, len(ids))
+        yield ids[i:end], text[offsets[i][0]:offsets[end - 1][1]]
+        if end == len(ids):
+            break
 
 
-def embed_text(text: str, session: ort.InferenceSession, tokenizer, max_length: int = 512) -> np.ndarray:
+def create_database(db_path: str, backend: str = "vec", vec_path: Optional[str] = None):
     """
-    Generate embeddings for text using ONNX model.
+    Create SQLite database for documents and embeddings.
     
     Args:
-        text: Input text to embed
-        session: ONNX runtime session
-        tokenizer: HuggingFace tokenizer
-        max_length: Maximum sequence length
-    
-    Returns:
-        384-dimensional embedding vector
+        db_path: Path to the database file
+        backend: "linear" for the plain tables only, "vec" to also create
+            the sqlite-vec vec_documents table
+        vec_path: Compiled sqlite-vec extension (e.g. vec0.dylib) to load
+            if the sqlite-vec package isn't installed
     """
-    # Tokenize
-    inputs = tokenizer(
-        text,
-        padding=True,
-        truncation=True,
-        max_length=max_length,
-        return_tensors="np"
-    )
-    
-    # Run inference
-    outputs = session.run(
-        ["last_hidden_state"],
-        {
-            "input_ids": inputs["input_ids"].astype(np.int64),
-            "attention_mask": inputs["attention_mask"].astype(np.int64),
-            "token_type_ids": inputs["token_type_ids"].astype(np.int64)
-        }
-    )
-    
-    # Mean pooling over sequence length
-    last_hidden = outputs[0]  # Shape: (batch_size, seq_len, hidden_size)
-    attention_mask = inputs["attention_mask"]
-    
-    # Expand attention mask for broadcasting
-    mask_expanded = np.expand_dims(attention_mask, -1)
-    
-    # Apply mask and compute mean
-    sum_embeddings = np.sum(last_hidden * mask_expanded, axis=1)
-    sum_mask = np.sum(mask_expanded, axis=1)
-    embedding = sum_embeddings / np.maximum(sum_mask, 1e-9)
-    
-    return embedding[0]  # Return first (and only) batch item
-
-
-def serialize_f32(vector: np.ndarray) -> bytes:
-    """Serialize float32 vector to bytes for storage."""
-    return vector.astype(np.float32).tobytes()
-
-
-def create_database(db_path: str):
-    """Create SQLite database for documents and embeddings."""
     print(f"Creating database at {db_path}")
     conn = sqlite3.connect(db_path)
     
+    # The extension is also needed to drop an existing vec_documents table,
+    # so load it for linear builds too when it's available
+    has_vec = load_vec_extension(conn, vec_path)
+    if backend == "vec" and not has_vec:
+        raise SystemExit("sqlite-vec is required for --backend vec (pip install sqlite-vec)")
+    if not has_vec and conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'vec_documents'"
+    ).fetchone():
+        conn.close()
+        raise SystemExit(
+            f"{db_path} has a vec_documents table that can't be dropped without sqlite-vec; "
+            "install sqlite-vec or delete the database file"
+        )
+    
+    # Faster bulk inserts; main() switches back to a rollback journal
+    # before closing so the shipped database is a single file
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+    """)
+    
     # Reset database
+    if has_vec:
+        conn.execute("DROP TABLE IF EXISTS vec_documents")
     conn.executescript("""
         DROP TABLE IF EXISTS document_embeddings;
         DROP TABLE IF EXISTS documents;
+        DROP TABLE IF EXISTS metadata;
     """)
 
     conn.executescript("""
@@ -125,135 +125,281 @@ def create_database(db_path: str):
         );
         
         CREATE INDEX idx_source ON documents(source);
+        
+        -- Build settings, e.g. which model produced the embeddings
+        CREATE TABLE metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
     """)
     
+    if backend == "vec":
+        conn.executescript("""
+            -- sqlite-vec index for k-nearest-neighbour search, stored as
+            -- int8 (unit vectors quantized with vec_quantize_int8)
+            CREATE VIRTUAL TABLE vec_documents USING vec0(
+                document_id INTEGER PRIMARY KEY,
+                embedding INT8[384] distance_metric=cosine
+            );
+        """)
+    
     conn.commit()
     return conn
 
 
-def process_knowledge_base(kb_dir: Path, session, tokenizer, conn: sqlite3.Connection):
+# Per-process model state for process_knowledge_base workers
+_worker_session = None
+_worker_tokenizer = None
+
+
+def _init_worker(model_path: str, tokenizer_path: str, intra_op_num_threads: int):
+    """Load a private ONNX session and tokenizer in each worker process."""
+    global _worker_session, _worker_tokenizer
+    _worker_session = create_session(model_path, intra_op_num_threads)
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+
+
+def _embed_file(txt_file: Path, batch_size: int = 32) -> Tuple[List[str], np.ndarray]:
+    """
+    Read, chunk and embed one file in a worker process.
+    
+    Chunks are pulled from chunk_tokens several batches at a time and
+    embedded straight from their token ids, so embed_token_ids can group
+    similar lengths (the short last window of each file) while only a few
+    batches of token windows are held at once. The file's texts and
+    embeddings are still returned whole, since results cross the process
+    boundary one file at a time.
+    """
+    text = txt_file.read_text(encoding='utf-8')
+    
+    # Tokenize once and chunk by token windows
+    token_chunks = chunk_tokens(text, _worker_tokenizer, size=384, overlap=64)
+    
+    chunks = []
+    embeddings = []
+    while True:
+        batch = list(islice(token_chunks, 8 * batch_size))
+        if not batch:
+            break
+        chunks.extend(chunk for _, chunk in batch)
+        embeddings.append(embed_token_ids(
+            [ids for ids, _ in batch], _worker_session, _worker_tokenizer, batch_size=batch_size
+        ))
+    
+    if not embeddings:
+        return [], np.empty((0, 384), dtype=np.float32)
+    return chunks, np.concatenate(embeddings, axis=0)
+
+
+def process_knowledge_base(kb_dir: Path, model_path: str, tokenizer_path: str, conn: sqlite3.Connection,
+                           backend: str = "vec", workers: Optional[int] = None, threads_per_worker: int = 2):
     """
     Process all text files in knowledge base directory.
     
+    Files are chunked and embedded in parallel by worker processes, each
+    with its own ONNX session; this process does all database writes.
+    
     Args:
         kb_dir: Path to knowledge base directory
-        session: ONNX runtime session
-        tokenizer: Tokenizer
+        model_path: Path to the ONNX model
+        tokenizer_path: Path to the tokenizer
         conn: Database connection
+        backend: "vec" also inserts embeddings into vec_documents
+        workers: Number of worker processes (defaults to cores / threads_per_worker)
+        threads_per_worker: ONNX intra-op threads per worker
     """
     txt_files = sorted(kb_dir.glob("*.txt"))
     print(f"\nFound {len(txt_files)} text files to process")
     
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    
     total_chunks = 0
+    next_id = 1  # Document ids are assigned here so inserts can be batched
     
-    for txt_file in tqdm(txt_files, desc="Processing files"):
-        try:
-            # Read file
-            text = txt_file.read_text(encoding='utf-8')
-            
-            # Chunk text
-            chunks = chunk_text(text, size=500, overlap=80)
+    # Build the whole knowledge base in a single transaction
+    conn.execute("BEGIN")
+    
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(model_path, tokenizer_path, threads_per_worker)
+    ) as executor:
+        futures = [executor.submit(_embed_file, txt_file) for txt_file in txt_files]
+        
+        # Collect in file order so document ids are deterministic
+        for txt_file, future in tqdm(zip(txt_files, futures), total=len(txt_files), desc="Processing files"):
+            try:
+                chunks, embeddings = future.result()
+            except Exception as e:
+                print(f"  ✗ Error processing {txt_file.name}: {e}")
+                continue
             
             print(f"  {txt_file.name}: {len(chunks)} chunks")
             
-            # Process each chunk
-            for chunk_id, chunk in enumerate(tqdm(chunks, desc=f"  Embedding", leave=False)):
-                # Generate embedding
-                embedding = embed_text(chunk, session, tokenizer)
-                
-                # Insert into database
-                cursor = conn.execute(
-                    "INSERT INTO documents (source, chunk_id, text) VALUES (?, ?, ?)",
-                    (txt_file.name, chunk_id, chunk)
+            # Insert into database; a savepoint makes each file all-or-nothing
+            # so a failed file leaves no rows holding on to its ids
+            conn.execute("SAVEPOINT file_insert")
+            try:
+                doc_ids = range(next_id, next_id + len(chunks))
+                conn.executemany(
+                    "INSERT INTO documents (id, source, chunk_id, text) VALUES (?, ?, ?, ?)",
+                    [(doc_id, txt_file.name, chunk_id, chunk)
+                     for chunk_id, (doc_id, chunk) in enumerate(zip(doc_ids, chunks))]
                 )
-                doc_id = cursor.lastrowid
-                
-                # Insert embedding
-                conn.execute(
+                embedding_rows = [(doc_id, serialize_f32(embedding)) for doc_id, embedding in zip(doc_ids, embeddings)]
+                conn.executemany(
                     "INSERT INTO document_embeddings (document_id, embedding) VALUES (?, ?)",
-                    (doc_id, serialize_f32(embedding))
+                    embedding_rows
                 )
-                
-                total_chunks += 1
+                if backend == "vec":
+                    conn.executemany(
+                        "INSERT INTO vec_documents (document_id, embedding) VALUES (?, vec_quantize_int8(?, 'unit'))",
+                        embedding_rows
+                    )
+            except Exception as e:
+                conn.execute("ROLLBACK TO file_insert")
+                conn.execute("RELEASE file_insert")
+                print(f"  ✗ Error inserting {txt_file.name}: {e}")
+                continue
+            conn.execute("RELEASE file_insert")
             
-            # Commit after each file
-            conn.commit()
-            
-        except Exception as e:
-            print(f"  ✗ Error processing {txt_file.name}: {e}")
-            continue
+            next_id += len(chunks)
+            total_chunks += len(chunks)
+    
+    conn.commit()
     
     print(f"\n✓ Processed {total_chunks} total chunks from {len(txt_files)} files")
 
 
-def test_search(conn: sqlite3.Connection, session, tokenizer, query: str = "How do I stop bleeding?"):
-    """Test the database by computing cosine similarity manually."""
+def export_embedding_matrix(conn: sqlite3.Connection, npy_path: Path):
+    """
+    Write all embeddings to one contiguous (N, 384) float32 .npy file.
+    
+    Row i holds the embedding of document id i + 1, so searches can
+    memory-map the matrix and only hit SQLite for the top results.
+    """
+    rows = conn.execute(
+        "SELECT document_id, embedding FROM document_embeddings ORDER BY document_id"
+    ).fetchall()
+    
+    doc_ids = [doc_id for doc_id, _ in rows]
+    if doc_ids != list(range(1, len(rows) + 1)):
+        raise ValueError("Document ids must run from 1 to N to index the embedding matrix by row")
+    
+    matrix = np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32)
+    np.save(npy_path, matrix.reshape(len(rows), 384))
+    print(f"✓ Saved embedding matrix to {npy_path}")
+
+
+def test_search(conn: sqlite3.Connection, session, tokenizer, query: str = "How do I stop bleeding?",
+                top_k: int = 5, backend: str = "vec", matrix: Optional[np.ndarray] = None):
+    """
+    Test the database with a top-k search.
+    
+    The vec backend runs a sqlite-vec MATCH query; the linear backend scores
+    the embedding matrix (see export_embedding_matrix) in NumPy.
+    """
     print(f"\n{'='*60}")
     print(f"Testing search with query: '{query}'")
     print(f"{'='*60}\n")
 
     query_embedding = embed_text(query, session, tokenizer).astype(np.float32)
 
-    cursor = conn.execute("""
-        SELECT d.source, d.chunk_id, d.text, e.embedding
-        FROM documents d
-        JOIN document_embeddings e ON d.id = e.document_id
-    """)
-
-    rows = []
-    for source, chunk_id, text, blob in cursor:
-        vector = np.frombuffer(blob, dtype=np.float32)
-        if vector.shape != query_embedding.shape:
-            continue
-        dot = float(np.dot(query_embedding, vector))
-        norm = float(np.linalg.norm(query_embedding) * np.linalg.norm(vector))
-        score = 0.0 if norm == 0 else dot / norm
-        rows.append((score, source, chunk_id, text))
-
-    rows.sort(reverse=True, key=lambda r: r[0])
-    top = rows[:5]
+    if backend == "vec":
+        results = [
+            (1.0 - distance, source, chunk_id, text)
+            for source, chunk_id, text, distance in conn.execute("""
+                SELECT d.source, d.chunk_id, d.text, v.distance
+                FROM vec_documents v
+                JOIN documents d ON v.document_id = d.id
+                WHERE v.embedding MATCH vec_quantize_int8(?, 'unit') AND k = ?
+                ORDER BY v.distance
+            """, (serialize_f32(query_embedding), top_k))
+        ]
+    else:
+        results = linear_search(conn, matrix, query_embedding, top_k)
 
-    print(f"Top {len(top)} results:\n")
-    for i, (score, source, chunk_id, text) in enumerate(top, 1):
+    print(f"Top {len(results)} results:\n")
+    for i, (score, source, chunk_id, text) in enumerate(results, 1):
         print(f"{i}. [{source} - chunk {chunk_id}] (score: {score:.4f})")
         print(f"   {text[:200]}...")
         print()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Build the RAG database from tools/kb.")
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="vec",
+        help="vec: also build a sqlite-vec index; linear: plain tables only (default: vec)"
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Embed with onnx-out/model.int8.onnx (see quantize_onnx.py). The iOS app embeds "
+             "queries with the FP32 model, so only use this for databases queried by query_rag.py"
+    )
+    args = parser.parse_args()
+    
     # Paths
     base_dir = Path(__file__).parent.parent
     kb_dir = base_dir / "tools" / "kb"
     model_path = str(base_dir / "onnx-out" / "model.onnx")
     tokenizer_path = str(base_dir / "onnx-out")
     db_path = str(base_dir / "rag_database.db")
+    npy_path = base_dir / "embeddings.npy"
+    vec_path = str(base_dir / "vec0.dylib")
+    
+    if args.int8:
+        model_path = int8_model_path(model_path)
+        if not Path(model_path).exists():
+            raise SystemExit(f"{model_path} not found; run quantize_onnx.py first")
     
     print("="*60)
-    print("Building RAG Database with SQLite Vec")
+    print("Building RAG Database")
     print("="*60)
+    print(f"Backend: {args.backend}")
     print(f"Knowledge base: {kb_dir}")
     print(f"Model: {model_path}")
     print(f"Database: {db_path}")
     print()
     
-    # Load model
+    # Load model (also writes the optimized graph cache before workers start)
     session, tokenizer = load_onnx_model(model_path, tokenizer_path)
     
-    # Create database
-    conn = create_database(db_path)
-    
-    # Process knowledge base
-    process_knowledge_base(kb_dir, session, tokenizer, conn)
-    
-    # Capture counts before closing
-    total_docs = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+    # Remove the old sidecar so a failed rebuild can't leave it pointing
+    # at a different set of documents
+    npy_path.unlink(missing_ok=True)
     
-    # Test search
-    test_search(conn, session, tokenizer, "How do I stop severe bleeding?")
-    test_search(conn, session, tokenizer, "What should I do for a broken bone?")
-    test_search(conn, session, tokenizer, "How to purify water in emergency?")
-    
-    conn.close()
+    # Create database
+    conn = create_database(db_path, args.backend, vec_path)
+    try:
+        conn.execute(
+            "INSERT INTO metadata (key, value) VALUES ('embedding_model', ?)",
+            (Path(model_path).name,)
+        )
+        conn.commit()
+        
+        # Process knowledge base
+        process_knowledge_base(kb_dir, model_path, tokenizer_path, conn, args.backend)
+        
+        # Capture counts before closing
+        total_docs = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+        
+        # Write the memory-mappable embedding matrix used by query_rag.py
+        export_embedding_matrix(conn, npy_path)
+        matrix = np.load(npy_path, mmap_mode='r')
+        
+        # Test search
+        test_search(conn, session, tokenizer, "How do I stop severe bleeding?", backend=args.backend, matrix=matrix)
+        test_search(conn, session, tokenizer, "What should I do for a broken bone?", backend=args.backend, matrix=matrix)
+        test_search(conn, session, tokenizer, "How to purify water in emergency?", backend=args.backend, matrix=matrix)
+    finally:
+        # Leave a single-file database even if the build failed part way
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
     
     print(f"\n✓ Database created successfully at: {db_path}")
     print(f"  Total documents: {total_docs}")
@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 """
 Convert BGE embedding model to Core ML format for iOS.
+
+Produces an FP16 ML Program (.mlpackage) with a flexible sequence length
+of 1-512 tokens. Pass --palettize-bits N for N-bit weight palettization.
 """
 
+import argparse
+from pathlib import Path
+from typing import Optional
 import torch
 import coremltools as ct
+import coremltools.optimize.coreml as cto
 from transformers import AutoModel, AutoTokenizer
 import numpy as np
 
-def convert_bge_to_coreml():
+MAX_SEQ_LEN = 512
+
+
+def package_size_mb(path: str) -> float:
+    """Total size of an .mlpackage directory in MB."""
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file()) / (1024*1024)
+
+
+def convert_bge_to_coreml(palettize_bits: Optional[int] = None):
     print("📦 Loading BGE model...")
     model = AutoModel.from_pretrained("BAAI/bge-small-en-v1.5")
     tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-small-en-v1.5")
@@ -22,7 +37,7 @@ def convert_bge_to_coreml():
     inputs = tokenizer(
         example_text,
         return_tensors="pt",
-        max_length=512,
+        max_length=MAX_SEQ_LEN,
         padding="max_length",
         truncation=True
     )
@@ -40,19 +55,32 @@ def convert_bge_to_coreml():
         )
     
     print("🍎 Converting to Core ML...")
-    # Convert to Core ML
+    # Flexible sequence length so short inputs don't pay for 512 tokens
+    seq_len = ct.RangeDim(lower_bound=1, upper_bound=MAX_SEQ_LEN, default=MAX_SEQ_LEN)
+    
+    # Convert to an FP16 ML Program that can run on the Neural Engine
     mlmodel = ct.convert(
         traced_model,
         inputs=[
-            ct.TensorType(name="input_ids", shape=(1, 512), dtype=np.int32),
-            ct.TensorType(name="attention_mask", shape=(1, 512), dtype=np.int32),
+            ct.TensorType(name="input_ids", shape=(1, seq_len), dtype=np.int32),
+            ct.TensorType(name="attention_mask", shape=(1, seq_len), dtype=np.int32),
         ],
         outputs=[
             ct.TensorType(name="last_hidden_state")
         ],
-        minimum_deployment_target=ct.target.iOS16,
+        convert_to="mlprogram",
+        compute_precision=ct.precision.FLOAT16,
+        compute_units=ct.ComputeUnit.ALL,
+        minimum_deployment_target=ct.target.iOS17,
     )
     
+    if palettize_bits:
+        print(f"🎨 Palettizing weights to {palettize_bits} bits...")
+        config = cto.OptimizationConfig(
+            global_config=cto.OpPalettizerConfig(mode="kmeans", nbits=palettize_bits)
+        )
+        mlmodel = cto.palettize_weights(mlmodel, config)
+    
     # Add metadata
     mlmodel.short_description = "BGE Small EN v1.5 - Sentence Embedding Model"
     mlmodel.author = "BAAI"
@@ -60,16 +88,24 @@ def convert_bge_to_coreml():
     mlmodel.version = "1.5"
     
     # Save the model
-    output_path = "BGEEmbedder.mlmodel"
+    output_path = "BGEEmbedder.mlpackage"
     mlmodel.save(output_path)
     
     print(f"✅ Model saved to: {output_path}")
-    print(f"📏 Model size: {os.path.getsize(output_path) / (1024*1024):.1f} MB")
+    print(f"📏 Model size: {package_size_mb(output_path):.1f} MB")
     print("\n📋 Next steps:")
-    print("1. Copy BGEEmbedder.mlmodel to app/ios/Runner/")
+    print("1. Copy BGEEmbedder.mlpackage to app/ios/Runner/")
     print("2. Open Xcode and drag the file into the project")
     print("3. Xcode will auto-generate Swift code for the model")
 
 if __name__ == "__main__":
-    import os
-    convert_bge_to_coreml()
+    parser = argparse.ArgumentParser(description="Convert BGE to Core ML.")
+    parser.add_argument(
+        "--palettize-bits",
+        type=int,
+        choices=[2, 4, 6, 8],
+        default=None,
+        help="Palettize weights to this many bits (default: keep FP16 weights)"
+    )
+    args = parser.parse_args()
+    convert_bge_to_coreml(args.palettize_bits)
@@ -1,13 +1,22 @@
 import pdfplumber, json, re
+from multiprocessing import Pool
 from pathlib import Path
 from tqdm import tqdm
 
 def chunk_text(text, size=500, overlap=80):
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), size - overlap):
-        chunks.append(" ".join(words[i:i+size]))
-    return chunks
+    if size <= overlap:
+        raise ValueError(f"chunk size ({size}) must be larger than overlap ({overlap})")
+    window = []
+    emitted = False
+    for match in re.finditer(r"\S+", text):
+        window.append(match.group())
+        if len(window) == size:
+            yield " ".join(window)
+            emitted = True
+            window = window[size - overlap:]
+    # Trailing words not already covered by the last full chunk
+    if len(window) > (overlap if emitted else 0):
+        yield " ".join(window)
 
 def extract_from_pdf(path):
     with pdfplumber.open(path) as pdf:
@@ -21,10 +30,14 @@ def extract_from_pdf(path):
                     "text": chunk
                 }
 
-if __name__ == "__main__":
-    docs = list(Path(".").glob("*.pdf"))
-    all_chunks = []
-    for doc in tqdm(docs):
-        all_chunks.extend(list(extract_from_pdf(doc)))
-    Path("chunks.jsonl").write_text("\n".join(json.dumps(c) for c in all_chunks))
+def extract_chunks(path):
+    # Runs in a worker process; only one PDF's chunks are held at a time
+    return list(extract_from_pdf(path))
 
+if __name__ == "__main__":
+    docs = sorted(Path(".").glob("*.pdf"))
+    with Path("chunks.jsonl").open("w") as f, Pool() as pool:
+        # imap keeps document order while PDFs are extracted in parallel
+        for chunks in tqdm(pool.imap(extract_chunks, docs), total=len(docs)):
+            for c in chunks:
+                f.write(json.dumps(c) + "\n")
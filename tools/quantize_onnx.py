@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Quantize the BGE ONNX embedding model to INT8 with dynamic quantization.
+Writes onnx-out/model.int8.onnx next to the FP32 model. Build with
+`build_rag_db.py --int8` to use it; query_rag.py then picks it up from the
+database. The iOS app always embeds queries with the FP32 model, so databases
+shipped to the app should be built without --int8.
+
+Usage: python quantize_onnx.py
+"""
+
+from pathlib import Path
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+
+def quantize_model(model_path: Path, output_path: Path):
+    """Quantize model weights to int8; activations are quantized at runtime."""
+    print(f"Quantizing {model_path}")
+    quantize_dynamic(
+        str(model_path),
+        str(output_path),
+        weight_type=QuantType.QInt8
+    )
+    
+    fp32_size = model_path.stat().st_size / (1024 * 1024)
+    int8_size = output_path.stat().st_size / (1024 * 1024)
+    print(f"✓ Saved {output_path} ({fp32_size:.1f} MB -> {int8_size:.1f} MB)")
+
+
+def main():
+    base_dir = Path(__file__).parent.parent
+    model_path = base_dir / "onnx-out" / "model.onnx"
+    output_path = base_dir / "onnx-out" / "model.int8.onnx"
+    
+    quantize_model(model_path, output_path)
+    print("\nRebuild with `build_rag_db.py --int8` to embed with the quantized model.")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,87 +4,123 @@ Query the RAG database for similar documents.
 Usage: python query_rag.py "your search query"
 """
 
+import functools
 import sys
 import sqlite3
 import numpy as np
-import onnxruntime as ort
 from pathlib import Path
 from transformers import AutoTokenizer
 
+from rag_common import (
+    create_session,
+    embed_text,
+    linear_search,
+    load_vec_extension,
+    read_embedding_model,
+    serialize_f32,
+    vec_embedding_type,
+)
 
-def embed_text(text: str, session: ort.InferenceSession, tokenizer, max_length: int = 512) -> np.ndarray:
-    """Generate embeddings for text using ONNX model."""
-    inputs = tokenizer(
-        text,
-        padding=True,
-        truncation=True,
-        max_length=max_length,
-        return_tensors="np"
-    )
-    
-    outputs = session.run(
-        ["last_hidden_state"],
-        {
-            "input_ids": inputs["input_ids"].astype(np.int64),
-            "attention_mask": inputs["attention_mask"].astype(np.int64),
-            "token_type_ids": inputs["token_type_ids"].astype(np.int64)
-        }
-    )
-    
-    last_hidden = outputs[0]
-    attention_mask = inputs["attention_mask"]
-    mask_expanded = np.expand_dims(attention_mask, -1)
-    sum_embeddings = np.sum(last_hidden * mask_expanded, axis=1)
-    sum_mask = np.sum(mask_expanded, axis=1)
-    embedding = sum_embeddings / np.maximum(sum_mask, 1e-9)
-    
-    return embedding[0]
 
-
-def serialize_f32(vector: np.ndarray) -> bytes:
-    """Serialize float32 vector to bytes for sqlite-vec."""
-    return vector.astype(np.float32).tobytes()
-
-
-def search(query: str, top_k: int = 5):
-    """Search the RAG database for similar documents."""
+@functools.lru_cache(maxsize=1)
+def _get_resources():
+    """
+    Load the model, tokenizer, database connection and embedding matrix once per process.
+    
+    The matrix is memory-mapped from embeddings.npy when build_rag_db.py wrote
+    one; otherwise it is None and searches fall back to sqlite-vec.
+    """
     # Paths
     base_dir = Path(__file__).parent.parent
-    model_path = str(base_dir / "onnx-out" / "model.onnx")
     tokenizer_path = str(base_dir / "onnx-out")
     db_path = str(base_dir / "rag_database.db")
+    npy_path = base_dir / "embeddings.npy"
     vec_path = str(base_dir / "vec0.dylib")
     
-    # Load model
-    session = ort.InferenceSession(model_path)
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
-    
     # Connect to database
     conn = sqlite3.connect(db_path)
-    conn.enable_load_extension(True)
-    conn.load_extension(vec_path)
-    conn.enable_load_extension(False)
+    conn.execute("PRAGMA mmap_size=268435456")
+    
+    matrix = None
+    if npy_path.exists():
+        matrix = np.load(npy_path, mmap_mode='r')
+        
+        # Row i must be document id i + 1; a sidecar from another build would
+        # silently return the wrong chunks
+        count, max_id = conn.execute("SELECT COUNT(*), MAX(id) FROM documents").fetchone()
+        if len(matrix) != count or (max_id or 0) != count:
+            print(f"  embeddings.npy has {len(matrix)} rows but the database has {count} documents; "
+                  "ignoring it (rebuild with build_rag_db.py)")
+            matrix = None
+    
+    if matrix is None and not load_vec_extension(conn, vec_path):
+        conn.close()
+        raise RuntimeError("No usable embeddings.npy and sqlite-vec could not be loaded; run build_rag_db.py first")
+    
+    # Embed queries with the same model the database was built with; loaded
+    # after the checks above so a failing call stays cheap to retry
+    model_name = read_embedding_model(conn) or "model.onnx"
+    session = create_session(str(base_dir / "onnx-out" / model_name))
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    
+    return session, tokenizer, conn, matrix
+
+
+def search(query: str, top_k: int = 5):
+    """Search the RAG database for similar documents."""
+    session, tokenizer, conn, matrix = _get_resources()
     
     # Generate query embedding
-    query_embedding = embed_text(query, session, tokenizer)
+    query_embedding = embed_text(query, session, tokenizer).astype(np.float32)
+    
+    if matrix is not None:
+        return [
+            (source, chunk_id, text, 1.0 - score)
+            for score, source, chunk_id, text in linear_search(conn, matrix, query_embedding, top_k)
+        ]
+    
+    embedding_type = vec_embedding_type(conn)
+    if embedding_type is None:
+        raise RuntimeError("Database has no vec_documents table; rebuild it with build_rag_db.py")
     
     # Search
-    cursor = conn.execute("""
-        SELECT 
-            d.source,
-            d.chunk_id,
-            d.text,
-            distance
-        FROM vec_documents v
-        JOIN documents d ON v.document_id = d.id
-        WHERE embedding MATCH ? AND k = ?
-        ORDER BY distance
-    """, (serialize_f32(query_embedding), top_k))
-    
-    results = cursor.fetchall()
-    conn.close()
-    
-    return results
+    try:
+        if embedding_type == "int8":
+            cursor = conn.execute("""
+                SELECT 
+                    d.source,
+                    d.chunk_id,
+                    d.text,
+                    distance
+                FROM vec_documents v
+                JOIN documents d ON v.document_id = d.id
+                WHERE embedding MATCH vec_quantize_int8(?, 'unit') AND k = ?
+                ORDER BY distance
+            """, (serialize_f32(query_embedding), top_k))
+        else:
+            # Databases built before int8 storage have FLOAT[384] columns with
+            # the default L2 metric and unnormalized rows, where L2 against a
+            # unit query ranks mostly by document norm; score them by exact
+            # cosine distance instead
+            cursor = conn.execute("""
+                SELECT 
+                    d.source,
+                    d.chunk_id,
+                    d.text,
+                    vec_distance_cosine(v.embedding, ?) AS distance
+                FROM vec_documents v
+                JOIN documents d ON v.document_id = d.id
+                ORDER BY distance
+                LIMIT ?
+            """, (serialize_f32(query_embedding), top_k))
+    except sqlite3.OperationalError as e:
+        raise RuntimeError(
+            f"sqlite-vec query failed ({e}). The loaded sqlite-vec build may not support "
+            f"{embedding_type} vectors or distance_metric=cosine; install a current sqlite-vec "
+            "(pip install -U sqlite-vec) or rebuild the database with build_rag_db.py"
+        ) from e
+    
+    return cursor.fetchall()
 
 
 def main():
@@ -102,7 +138,10 @@ def main():
     print(f"Query: {query}")
     print(f"{'='*70}\n")
     
-    results = search(query, top_k=5)
+    try:
+        results = search(query, top_k=5)
+    except RuntimeError as e:
+        sys.exit(str(e))
     
     if not results:
         print("No results found.")
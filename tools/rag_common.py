@@ -0,0 +1,326 @@
+"""
+Shared helpers for the RAG tools: ONNX session setup, BGE embedding,
+vector serialization and search over the embedding matrix.
+Used by build_rag_db.py and query_rag.py.
+"""
+
+import os
+import platform
+import re
+import sqlite3
+import weakref
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+import onnxruntime as ort
+from transformers import AutoTokenizer
+
+try:
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
+
+
+def get_execution_providers() -> List[str]:
+    """Pick ONNX Runtime execution providers, falling back to CPU."""
+    preferred = []
+    if platform.system() == "Darwin":
+        preferred.append("CoreMLExecutionProvider")
+    elif platform.system() == "Windows":
+        preferred.append("DmlExecutionProvider")
+    
+    available = ort.get_available_providers()
+    return [p for p in preferred if p in available] + ["CPUExecutionProvider"]
+
+
+def create_session_options(intra_op_num_threads: Optional[int] = None) -> ort.SessionOptions:
+    """Session options with full graph optimization and one thread per core by default."""
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = intra_op_num_threads or os.cpu_count() or 1
+    sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return sess_options
+
+
+def create_session(model_path: str, intra_op_num_threads: Optional[int] = None) -> ort.InferenceSession:
+    """
+    Create an ONNX runtime session for the model.
+    
+    On CPU, the optimized (fused) graph is cached next to the model as
+    *.opt.onnx and reused until the source model is newer than the cache.
+    With a non-CPU provider (CoreML, DirectML) no cache is used: ENABLE_ALL
+    fuses ops into CPU-only kernels those providers can't run, so the graph
+    is optimized at load time after nodes are assigned to providers.
+    
+    Args:
+        model_path: Path to the ONNX model
+        intra_op_num_threads: Threads per operator (defaults to one per core)
+    
+    Returns:
+        ONNX runtime session
+    """
+    providers = get_execution_providers()
+    if providers != ["CPUExecutionProvider"]:
+        return ort.InferenceSession(
+            model_path,
+            create_session_options(intra_op_num_threads),
+            providers=providers
+        )
+    
+    optimized_path = Path(model_path).with_suffix(".opt.onnx")
+    if not optimized_path.exists() or optimized_path.stat().st_mtime < Path(model_path).stat().st_mtime:
+        sess_options = create_session_options(intra_op_num_threads)
+        sess_options.optimized_model_filepath = str(optimized_path)
+        return ort.InferenceSession(model_path, sess_options, providers=providers)
+    
+    return ort.InferenceSession(
+        str(optimized_path),
+        create_session_options(intra_op_num_threads),
+        providers=providers
+    )
+
+
+def int8_model_path(model_path: str) -> str:
+    """Path of the int8 model written by quantize_onnx.py for model_path."""
+    return str(Path(model_path).with_suffix(".int8.onnx"))
+
+
+def read_embedding_model(conn: sqlite3.Connection) -> Optional[str]:
+    """File name of the model the database's embeddings were built with, if recorded."""
+    has_metadata = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metadata'"
+    ).fetchone()
+    if not has_metadata:
+        return None
+    row = conn.execute("SELECT value FROM metadata WHERE key = 'embedding_model'").fetchone()
+    return row[0] if row else None
+
+
+def load_onnx_model(model_path: str, tokenizer_path: str):
+    """Load ONNX model and tokenizer."""
+    print(f"Loading ONNX model from {model_path}")
+    session = create_session(model_path)
+    
+    print(f"Loading tokenizer from {tokenizer_path}")
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    
+    return session, tokenizer
+
+
+# All-zero token_type_ids buffers, reused across calls for each session
+_token_type_buffers = weakref.WeakKeyDictionary()
+
+
+def _token_type_zeros(session: ort.InferenceSession, size: int, dtype) -> np.ndarray:
+    """Flat zeros buffer of at least size elements, grown only when needed."""
+    buffer = _token_type_buffers.get(session)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = np.zeros(size, dtype=dtype)
+        _token_type_buffers[session] = buffer
+    return buffer
+
+
+def embed_token_ids(token_ids: List[List[int]], session: ort.InferenceSession, tokenizer,
+                    max_length: int = 512, batch_size: int = 32) -> np.ndarray:
+    """
+    Generate embeddings for already-tokenized texts using ONNX model.
+    
+    Sequences are sorted by length and run through the model batch_size
+    at a time, so each batch is padded to a similar length. Results are
+    L2-normalized and returned in the original order.
+    
+    Args:
+        token_ids: Token ids per text, without special tokens
+        session: ONNX runtime session
+        tokenizer: HuggingFace tokenizer (for the special token ids)
+        max_length: Maximum sequence length, including [CLS] and [SEP]
+        batch_size: Number of sequences per inference call
+    
+    Returns:
+        Array of shape (len(token_ids), 384) with unit-length rows
+    """
+    if not token_ids:
+        return np.empty((0, 384), dtype=np.float32)
+    
+    # Wrap each sequence in [CLS] ... [SEP], truncating to max_length
+    sequences = [
+        [tokenizer.cls_token_id] + list(ids[:max_length - 2]) + [tokenizer.sep_token_id]
+        for ids in token_ids
+    ]
+    
+    # Order sequences by length to minimize padding within a batch
+    lengths = np.array([len(seq) for seq in sequences])
+    order = np.argsort(lengths, kind="stable")
+    
+    # Match the exported graph's inputs: feed int32 ids if the model takes
+    # them, and only pass token_type_ids if the graph has that input
+    dtypes = {
+        inp.name: np.int32 if inp.type == "tensor(int32)" else np.int64
+        for inp in session.get_inputs()
+    }
+    
+    # token_type_ids is all zeros for single-segment input; reuse the
+    # session's buffer and hand out contiguous views of the right shape
+    token_type_buffer = None
+    if "token_type_ids" in dtypes:
+        token_type_buffer = _token_type_zeros(
+            session, min(batch_size, len(sequences)) * lengths.max(), dtypes["token_type_ids"]
+        )
+    
+    embeddings = None
+    for start in range(0, len(sequences), batch_size):
+        batch_idx = order[start:start + batch_size]
+        
+        # Pad to the longest sequence in the batch
+        shape = (len(batch_idx), lengths[batch_idx].max())
+        input_ids = np.full(shape, tokenizer.pad_token_id, dtype=dtypes["input_ids"])
+        attention_mask = np.zeros(shape, dtype=dtypes["attention_mask"])
+        for row, i in enumerate(batch_idx):
+            input_ids[row, :lengths[i]] = sequences[i]
+            attention_mask[row, :lengths[i]] = 1
+        
+        feed = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask
+        }
+        if token_type_buffer is not None:
+            feed["token_type_ids"] = token_type_buffer[:input_ids.size].reshape(shape)
+        
+        # Run inference
+        outputs = session.run(["last_hidden_state"], feed)
+        
+        # Mean pooling over sequence length
+        last_hidden = outputs[0]  # Shape: (batch_size, seq_len, hidden_size)
+        
+        # Masked sum without materializing a (batch, seq_len, hidden) product
+        sum_embeddings = np.einsum('bld,bl->bd', last_hidden, attention_mask.astype(last_hidden.dtype))
+        sum_mask = attention_mask.sum(axis=1, keepdims=True)
+        batch_embeddings = sum_embeddings / np.maximum(sum_mask, 1e-9)
+        
+        # L2-normalize so cosine similarity is a plain dot product
+        batch_embeddings /= np.linalg.norm(batch_embeddings, axis=1, keepdims=True) + 1e-12
+        
+        # Scatter back to the original positions
+        if embeddings is None:
+            embeddings = np.empty((len(sequences), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+        embeddings[batch_idx] = batch_embeddings
+    
+    return embeddings
+
+
+def embed_texts(texts: List[str], session: ort.InferenceSession, tokenizer,
+                max_length: int = 512, batch_size: int = 32) -> np.ndarray:
+    """
+    Generate embeddings for a list of texts using ONNX model.
+    
+    Args:
+        texts: Input texts to embed
+        session: ONNX runtime session
+        tokenizer: HuggingFace tokenizer
+        max_length: Maximum sequence length
+        batch_size: Number of texts per inference call
+    
+    Returns:
+        Array of shape (len(texts), 384) with unit-length rows
+    """
+    if not texts:
+        return np.empty((0, 384), dtype=np.float32)
+    
+    token_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    return embed_token_ids(token_ids, session, tokenizer, max_length=max_length, batch_size=batch_size)
+
+
+def embed_text(text: str, session: ort.InferenceSession, tokenizer, max_length: int = 512) -> np.ndarray:
+    """
+    Generate embeddings for text using ONNX model.
+    
+    Args:
+        text: Input text to embed
+        session: ONNX runtime session
+        tokenizer: HuggingFace tokenizer
+        max_length: Maximum sequence length
+    
+    Returns:
+        384-dimensional unit-length embedding vector
+    """
+    return embed_texts([text], session, tokenizer, max_length=max_length)[0]
+
+
+def serialize_f32(vector: np.ndarray) -> bytes:
+    """Serialize L2-normalized float32 vector to bytes for storage."""
+    vector = vector.astype(np.float32)
+    return (vector / (np.linalg.norm(vector) + 1e-12)).tobytes()
+
+
+def load_vec_extension(conn: sqlite3.Connection, extension_path: Optional[str] = None) -> bool:
+    """
+    Load the sqlite-vec extension into the connection.
+    
+    Uses the sqlite-vec Python package, or the compiled extension at
+    extension_path (e.g. vec0.dylib) if the package isn't installed.
+    
+    Returns:
+        False if the extension couldn't be loaded
+    """
+    if sqlite_vec is None and extension_path is None:
+        print("  sqlite-vec not installed")
+        return False
+    try:
+        conn.enable_load_extension(True)
+        if sqlite_vec is not None:
+            sqlite_vec.load(conn)
+        else:
+            conn.load_extension(extension_path)
+        conn.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        print(f"  Could not load sqlite-vec ({e})")
+        return False
+    return True
+
+
+def vec_embedding_type(conn: sqlite3.Connection) -> Optional[str]:
+    """
+    Element type of vec_documents.embedding ("float" or "int8"), or None if
+    the table doesn't exist. Databases built before int8 storage use float.
+    """
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'vec_documents'"
+    ).fetchone()
+    if row is None:
+        return None
+    match = re.search(r"embedding\s+(\w+)\s*\[", row[0], re.IGNORECASE)
+    return match.group(1).lower() if match else None
+
+
+def linear_search(conn: sqlite3.Connection, matrix: np.ndarray, query_embedding: np.ndarray, top_k: int = 5):
+    """
+    Score every embedding against the query with a single matmul.
+    
+    Args:
+        conn: Database connection
+        matrix: (N, 384) unit-length embeddings, row i = document id i + 1
+        query_embedding: Unit-length query vector
+        top_k: Number of results
+    
+    Returns:
+        List of (score, source, chunk_id, text), best first
+    """
+    k = min(top_k, len(matrix))
+    if k == 0:
+        return []
+
+    # With unit-length vectors cosine similarity is a single matmul
+    scores = matrix @ query_embedding
+
+    # O(N) partial selection of the top k, then sort just those k
+    top_idx = np.argpartition(-scores, k - 1)[:k]
+    top_idx = top_idx[np.argsort(-scores[top_idx])]
+
+    results = []
+    for idx in top_idx:
+        source, chunk_id, text = conn.execute(
+            "SELECT source, chunk_id, text FROM documents WHERE id = ?",
+            (int(idx) + 1,)
+        ).fetchone()
+        results.append((float(scores[idx]), source, chunk_id, text))
+    return results